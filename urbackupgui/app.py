@@ -1,12 +1,17 @@
+import functools
+import hashlib
 import json
+import logging
+import shutil
 import subprocess
 import sys
+import threading
+import time
 import typing
 from datetime import datetime
-from string import Template
 from pathlib import Path
 
-from qtpy.QtCore import Qt, Slot, Signal, QTimer, QEvent
+from qtpy.QtCore import Qt, Slot, Signal, QEvent, QObject, QThread
 from qtpy.QtGui import QIcon
 from qtpy.QtWidgets import (
     QApplication,
@@ -26,19 +31,48 @@ from qtpy.QtWidgets import (
 
 # Globals ##############################################################################################################
 RESOURCE_PATH = Path(__file__).resolve().parent
+IS_WIN32 = sys.platform == "win32"
+LOGGER = logging.getLogger(__name__)
+ICON_FILES = {
+    "not_connected": "database_red.ico",
+    "connected": "database_white.ico",
+    "busy": "database_yellow.ico",
+}
+
+# Helper Functions #####################################################################################################
+
+
+# Icons are only read from disk the first time they are shown, then shared by the tray and the window
+@functools.lru_cache(maxsize=None)
+def load_icon(name: str) -> QIcon:
+    return QIcon(str(RESOURCE_PATH.joinpath("icons", ICON_FILES[name])))
+
+
+# The last backup time only changes when a backup finishes, so most polls format the same timestamp
+@functools.lru_cache(maxsize=4)
+def format_timestamp(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%m/%d/%Y %I:%M:%S %p")
+
 
 # Helper Classes #######################################################################################################
 
 
+# The parts of `urbackupclientctl status` that are used, parsed once per poll
+class Status(typing.NamedTuple):
+    running_processes: list
+    internet_status: str
+    servers: list
+    time_since_last_lan_connection: int
+    last_backup_time: typing.Optional[int]
+
+
 # I just want a scrollable list widget with no highlighting on items
 # It is just to display a list of string
 class ListWidget(QListWidget):
-    def __init__(self, parent: QWidget) -> None:
+    def __init__(self, parent: QWidget, bg: str) -> None:
         super().__init__(parent)
         self.setFocusPolicy(Qt.NoFocus)
-        self.setStyleSheet(
-            f"background-color: {parent.palette().window().color().name()}; border: none;"
-        )
+        self.setStyleSheet(f"background-color: {bg}; border: none;")
 
     def mousePressEvent(self, event: QEvent) -> None:
         pass
@@ -47,6 +81,95 @@ class ListWidget(QListWidget):
         pass
 
 
+# Polls urbackupclientctl on its own thread so the GUI thread never waits on it.
+# Polls are run at fixed points start + n * interval on the monotonic clock, so slow calls don't make the cadence drift.
+class StatusPoller(QThread):
+    status_ready: Signal = Signal(bytes, object)
+
+    def __init__(
+        self, interval: float, parent: typing.Optional[QObject] = None
+    ) -> None:
+        super().__init__(parent)
+        self._interval = interval
+        self._stop = threading.Event()
+        # The running urbackupclientctl, so stop() can kill it if it hangs
+        self._proc: typing.Optional[subprocess.Popen] = None
+        self._proc_lock = threading.Lock()
+        # Reused between polls so the output isn't collected into a new bytes object each time
+        self._buf = bytearray(65536)
+
+    def run(self) -> None:
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.poll()
+
+            deadline += self._interval
+            now = time.monotonic()
+            # Drop any polls that were missed entirely rather than running them back to back
+            if deadline <= now:
+                deadline += ((now - deadline) // self._interval + 1) * self._interval
+            self._stop.wait(deadline - now)
+
+    def poll(self) -> None:
+        try:
+            key, status = self.get_status()
+        except (OSError, ValueError, KeyError):
+            key, status = b"", None
+        except Exception:
+            # Anything else would end run() and stop polling for good, so log it and try again next time
+            LOGGER.exception("Unexpected error while getting the status")
+            key, status = b"", None
+        self.status_ready.emit(key, status)
+
+    def stop(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        with self._proc_lock:
+            if self._proc is not None:
+                self._proc.kill()
+        self.wait()
+
+    def get_status(self) -> tuple[bytes, typing.Optional[Status]]:
+        try:
+            with subprocess.Popen(
+                ["urbackupclientctl", "status"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ) as proc:
+                with self._proc_lock:
+                    self._proc = proc
+                    # stop() may have been called before the process was started
+                    if self._stop.is_set():
+                        proc.kill()
+                assert proc.stdout is not None
+                size = 0
+                while True:
+                    if size == len(self._buf):
+                        self._buf.extend(bytes(len(self._buf)))
+                    read = proc.stdout.readinto(memoryview(self._buf)[size:])
+                    if not read:
+                        break
+                    size += read
+                returncode = proc.wait()
+        finally:
+            with self._proc_lock:
+                self._proc = None
+        if returncode != 0:
+            return b"", None
+        else:
+            output = memoryview(self._buf)[:size]
+            # json.loads() won't take a memoryview, but str() can decode straight from it
+            data = json.loads(str(output, "utf-8"))
+            return hashlib.blake2b(output).digest(), Status(
+                data["running_processes"],
+                data["internet_status"],
+                data["servers"],
+                data["time_since_last_lan_connection"],
+                data.get("last_backup_time"),
+            )
+
+
 class StatusInfo(QWidget):
     statuses = {
         "FULL": "Full file backup running.",
@@ -55,23 +178,20 @@ class StatusInfo(QWidget):
         "R_INCR": "Resumed incremental file backup.",
         "IDLE": "Idle.",
     }
-    status_format = Template("$status $progress")
-    eta_format = Template("ETA: $time")
-    last_backup_format = Template("Last backup on $date")
-    connect_to_local_format = Template("${status}onnected to local UrBackup server.")
-    last_seen_format = Template("Local server last seen $minutes minutes ago.")
+    _CONNECTED = "Connected to local UrBackup server."
+    _NOT_CONNECTED = "Not connected to local UrBackup server."
 
-    def __init__(self, parent) -> None:
+    def __init__(self, parent, bg: str) -> None:
         super().__init__(parent)
         layout = QVBoxLayout()
         self.setLayout(layout)
         layout.setSpacing(10)
 
+        self._server_lines: list[str] = []
+        self._last_percent: typing.Optional[int] = None
+
         # Current status
-        self.status_text = QLabel(
-            self.status_format.substitute(status=self.statuses["IDLE"], progress=""),
-            self,
-        )
+        self.status_text = QLabel(f'{self.statuses["IDLE"]} ', self)
         layout.addWidget(self.status_text, alignment=Qt.AlignLeft)
 
         self.eta_text = QLabel("", self)
@@ -98,7 +218,7 @@ class StatusInfo(QWidget):
         servers_widget.setLayout(servers_layout)
         servers_label = QLabel("Servers:", self)
         servers_layout.addWidget(servers_label, alignment=Qt.AlignTop)
-        self.servers = ListWidget(self)
+        self.servers = ListWidget(self, bg)
         servers_layout.addWidget(self.servers)
         layout.addWidget(servers_widget, alignment=Qt.AlignLeft)
 
@@ -110,24 +230,33 @@ class StatusInfo(QWidget):
         connect_layout.addWidget(
             QLabel("Connection status:", connect_widget), alignment=Qt.AlignTop
         )
-        self.connect_status = QLabel(
-            f'{self.connect_to_local_format.substitute(status="Not c")}',
-            connect_widget,
-        )
+        self.connect_status = QLabel(self._NOT_CONNECTED, connect_widget)
         self.connect_status.setFixedHeight(35)
         self.connect_status.setAlignment(Qt.AlignLeft | Qt.AlignTop)
         connect_widget.layout().addWidget(self.connect_status)
         layout.addWidget(connect_widget, alignment=Qt.AlignLeft)
 
-    @Slot(dict)
-    def update_status(self, status: typing.Optional[dict]) -> None:
+    @staticmethod
+    def _set_text(label: QLabel, text: str) -> None:
+        # setText() relayouts and repaints even when the text is the same
+        if label.text() != text:
+            label.setText(text)
+
+    def _set_progress(self, percent: int) -> None:
+        if percent != self._last_percent:
+            self.progress_bar.setValue(percent)
+            self._last_percent = percent
+
+    @Slot(object)
+    def update_status(self, status: typing.Optional[Status]) -> None:
         if status is None:
-            self.status_text.setText("Could not get status!")
-            self.eta_text.setText("")
-            self.progress_bar.setValue(0)
-            self.last_backup.setText("")
+            self._set_text(self.status_text, "Could not get status!")
+            self._set_text(self.eta_text, "")
+            self._set_progress(0)
+            self._set_text(self.last_backup, "")
             self.servers.clear()
-            self.connect_status.setText("Unknown")
+            self._server_lines = []
+            self._set_text(self.connect_status, "Unknown")
             return
 
         # Current status
@@ -135,73 +264,82 @@ class StatusInfo(QWidget):
         progress = ""
         percent = 0
         eta = None
-        if len(status["running_processes"]) > 0:
-            curr_status = status["running_processes"][0]["action"]
-            eta = status["running_processes"][0]["eta_ms"]
-            percent = status["running_processes"][0]["percent_done"]
+        if len(status.running_processes) > 0:
+            process = status.running_processes[0]
+            curr_status = process["action"]
+            eta = process["eta_ms"]
+            percent = process["percent_done"]
 
             if percent == -1:
                 progress = "Indexing."
                 percent = 0
             else:
                 progress = f"{percent}% done."
-        self.status_text.setText(
-            self.status_format.substitute(
-                status=self.statuses[curr_status], progress=progress
-            )
-        )
+        self._set_text(self.status_text, f"{self.statuses[curr_status]} {progress}")
         if eta is not None and eta != -1:
-            eta = f"{eta // 3600000} hours {eta // 60000} minutes"
-            self.eta_text.setText(self.eta_format.substitute(time=eta))
+            hours, rem = divmod(eta, 3_600_000)
+            minutes = rem // 60_000
+            self._set_text(self.eta_text, f"ETA: {hours} hours {minutes} minutes")
         else:
-            self.eta_text.setText("")
-        self.progress_bar.setValue(percent)
+            self._set_text(self.eta_text, "")
+        self._set_progress(percent)
 
         # Server and backup information
-        last_backup = None
-        if "last_backup_time" in status:
-            last_backup = datetime.fromtimestamp(status["last_backup_time"]).strftime(
-                "%m/%d/%Y %I:%M:%S %p"
-            )
-        if last_backup is not None:
-            self.last_backup.setText(
-                self.last_backup_format.substitute(date=last_backup)
-            )
-        self.servers.clear()
-        for server in status["servers"]:
-            self.servers.addItem(
-                f"{server['name']} (Internet: {'Yes' if server['internet_connection'] else 'No'})"
-            )
-        internet_status = status["internet_status"]
-        last_seen = status["time_since_last_lan_connection"] // 60000
+        if status.last_backup_time is not None:
+            last_backup = format_timestamp(status.last_backup_time)
+            self._set_text(self.last_backup, f"Last backup on {last_backup}")
+        server_lines = [
+            f"{server['name']} (Internet: {'Yes' if server['internet_connection'] else 'No'})"
+            for server in status.servers
+        ]
+        if server_lines != self._server_lines:
+            self.update_servers(server_lines)
+        internet_status = status.internet_status
+        last_seen = status.time_since_last_lan_connection // 60000
         if internet_status == "wait_local":
             connect_status = "Waiting for local UrBackup server."
         elif internet_status == "no_server":
             connect_status = "No servers"
         else:
-            connect_status = f'{self.connect_to_local_format.substitute(status="C" if internet_status == "connected_local" else "Not c")}\n{self.last_seen_format.substitute(minutes=last_seen)}'
-        self.connect_status.setText(connect_status)
+            connected = (
+                self._CONNECTED
+                if internet_status == "connected_local"
+                else self._NOT_CONNECTED
+            )
+            connect_status = (
+                f"{connected}\nLocal server last seen {last_seen} minutes ago."
+            )
+        self._set_text(self.connect_status, connect_status)
+
+    def update_servers(self, lines: list[str]) -> None:
+        # Only touch the rows that changed and repaint the list once at the end
+        self.servers.setUpdatesEnabled(False)
+        try:
+            for row, (old, new) in enumerate(zip(self._server_lines, lines)):
+                if old != new:
+                    self.servers.item(row).setText(new)
+            for row in range(self.servers.count() - 1, len(lines) - 1, -1):
+                self.servers.takeItem(row)
+            self.servers.addItems(lines[self.servers.count() :])
+        finally:
+            self.servers.setUpdatesEnabled(True)
+        self._server_lines = lines
 
 
 # App ##################################################################################################################
 class App(QMainWindow):
-    status: Signal = Signal(dict)
+    status: Signal = Signal(object)
 
     def __init__(self) -> None:
         super().__init__(None)
         self.setWindowTitle("UrBackup Status")
         self.setFixedSize(500, 250)
+        self._bg: str = self.palette().window().color().name()
 
-        # Load icons
-        icon_dir = RESOURCE_PATH.joinpath("icons")
-        self.icons = {
-            "not_connected": QIcon(str(icon_dir.joinpath("database_red.ico"))),
-            "connected": QIcon(str(icon_dir.joinpath("database_white.ico"))),
-            "busy": QIcon(str(icon_dir.joinpath("database_yellow.ico"))),
-        }
-        self.setWindowIcon(self.icons["not_connected"])
+        self.setWindowIcon(load_icon("not_connected"))
+        self._current_icon_key: str = "not_connected"
 
-        if sys.platform == "win32":
+        if IS_WIN32:
             QMessageBox.critical(
                 self,
                 "Not supported",
@@ -210,9 +348,7 @@ class App(QMainWindow):
                 QMessageBox.NoButton,
             )
             sys.exit(1)
-        try:
-            self.get_status()
-        except FileNotFoundError:
+        if shutil.which("urbackupclientctl") is None:
             QMessageBox.critical(
                 self,
                 "UrBackup Error",
@@ -230,9 +366,10 @@ class App(QMainWindow):
         main_layout.setContentsMargins(5, 0, 5, 0)
 
         self.__closing: bool = False
+        self._last_status_key: typing.Optional[bytes] = None
 
         # System Tray Icon
-        self.tray_icon = QSystemTrayIcon(self.icons["not_connected"], self)
+        self.tray_icon = QSystemTrayIcon(load_icon("not_connected"), self)
         self.tray_icon.setToolTip(self.windowTitle())
         self.tray_icon.setVisible(True)
         self.tray_icon.activated.connect(self.tray_activated)  # type: ignore
@@ -247,17 +384,15 @@ class App(QMainWindow):
         self.status.connect(self.update_tray)
 
         # Status information
-        self.status_info = StatusInfo(self)
+        self.status_info = StatusInfo(self, self._bg)
         main_layout.addWidget(self.status_info)
         self.status.connect(self.status_info.update_status)
 
-        # Perform initial update
-        self.update_status()
-
-        # Start update timer
-        self.update_timer = QTimer(self)
-        self.update_timer.timeout.connect(self.update_status)  # type: ignore
-        self.update_timer.start(5000)
+        # Start polling, the first update happens right away
+        self.status_poller = StatusPoller(5.0, self)
+        self.status_poller.status_ready.connect(self.update_status)  # type: ignore
+        QApplication.instance().aboutToQuit.connect(self.status_poller.stop)  # type: ignore
+        self.status_poller.start()
 
     def close_app(self) -> None:
         self.__closing = True
@@ -272,7 +407,7 @@ class App(QMainWindow):
     def closeEvent(self, event: QEvent) -> None:
         if self.__closing or not self.tray_icon.isSystemTrayAvailable():
             # Closing steps
-            self.update_timer.stop()
+            self.status_poller.stop()
 
             event.accept()
         else:
@@ -295,38 +430,37 @@ class App(QMainWindow):
         if reason == QSystemTrayIcon.Trigger:
             self.open_and_show()
 
-    @Slot(dict)
-    def update_tray(self, status: typing.Optional[dict]) -> None:
+    @Slot(object)
+    def update_tray(self, status: typing.Optional[Status]) -> None:
         if status is None:
-            self.tray_icon.setIcon(self.icons["not_connected"])
-            self.setWindowIcon(self.icons["not_connected"])
-            return
-
-        internet_status = status["internet_status"]
-        if len(status["running_processes"]) > 0:
-            self.tray_icon.setIcon(self.icons["busy"])
-            self.setWindowIcon(self.icons["busy"])
-        elif internet_status == "connected_local":
-            self.tray_icon.setIcon(self.icons["connected"])
-            self.setWindowIcon(self.icons["connected"])
-        else:
-            self.tray_icon.setIcon(self.icons["not_connected"])
-            self.setWindowIcon(self.icons["not_connected"])
-
-    @staticmethod
-    def get_status() -> typing.Optional[dict]:
-        result = subprocess.run(["urbackupclientctl", "status"], capture_output=True)
-        if result.returncode != 0:
-            return None
+            key = "not_connected"
+        elif len(status.running_processes) > 0:
+            key = "busy"
+        elif status.internet_status == "connected_local":
+            key = "connected"
         else:
-            return json.loads(result.stdout)
+            key = "not_connected"
 
-    def update_status(self) -> None:
-        status = self.get_status()
+        if key == self._current_icon_key:
+            return
+        self.tray_icon.setIcon(load_icon(key))
+        self.setWindowIcon(load_icon(key))
+        self._current_icon_key = key
+
+    @Slot(bytes, object)
+    def update_status(self, key: bytes, status: typing.Optional[Status]) -> None:
+        # Nothing changed since the last poll, so there is nothing to redraw
+        if key == self._last_status_key:
+            return
+        self._last_status_key = key
         self.status.emit(status)
 
 
-if __name__ == "__main__":
+def main() -> None:
     app = QApplication()
     window = App()
     app.exec_()
+
+
+if __name__ == "__main__":
+    main()